@@ -38,11 +38,15 @@ class GLR_OT_FilterHelper_TextureList(Operator):
             if face.select:
                 obj_mat_idx = face.material_index
                 mat = obj.material_slots[obj_mat_idx].material
-                mat_ntn = mat.node_tree.nodes
-                mat_txt_img_node_idx = mat_ntn.find('Texture 0')
                 mat_txt_img_name = 'NO_TEXTURE'
-                if mat_txt_img_node_idx != -1:
-                    mat_txt_img_name = mat_ntn[mat_txt_img_node_idx].image.name[:-4]
+                mat_txt_img_node = mat.node_tree.nodes.get('Texture 0') if mat.node_tree else None
+                if mat_txt_img_node and mat_txt_img_node.image:
+                    mat_txt_img_name = mat_txt_img_node.image.name[:-4]
+                elif mat.get('N64 Texture 0'):
+                    # No texture node (eg. imported without shader
+                    # nodes); the CRC is then only in the custom prop
+                    # ('<crc>,<filter>')
+                    mat_txt_img_name = mat['N64 Texture 0'].split(',')[0]
                 if mat_txt_img_name not in cached_mats:
                     if len(cached_mats) == 0:
                         cached_mats += mat_txt_img_name
@@ -138,6 +142,36 @@ class GLR_OT_ImportGLR(Operator, ImportHelper):
         default=True,
     )
 
+    build_nodes: BoolProperty(
+        name='Build Shader Nodes',
+        description=(
+            'Builds a shader node tree emulating the N64 for each material. '
+            'When disabled, materials only get their settings and N64 custom '
+            'properties, which imports much faster'
+        ),
+        default=True,
+    )
+
+    debug_props: BoolProperty(
+        name='Add N64 Properties',
+        description=(
+            'Adds custom properties to each material describing its N64 '
+            'textures, color combiner and blender setup. Useful for debugging, '
+            'and the only record of them when shader nodes are not built'
+        ),
+        default=True,
+    )
+
+    emit_frames: BoolProperty(
+        name='Label Node Groups',
+        description=(
+            'Puts labeled frames around groups of shader nodes, like the '
+            'fog and texture coordinate wrapping nodes. They only make the '
+            'node tree easier to read'
+        ),
+        default=True,
+    )
+
     filter_mode: BoolProperty(
         name='Blacklist',
         description='Blacklist or whitelist mode for chosen filtered textures',
@@ -214,6 +248,9 @@ class GLR_PT_scene(Panel):
         layout.prop(operator, 'enable_mat_transparency')
         layout.prop(operator, 'enable_bf_culling')
         layout.prop(operator, 'enable_fog')
+        layout.prop(operator, 'build_nodes')
+        layout.prop(operator, 'debug_props')
+        layout.prop(operator, 'emit_frames')
 
 
 class GLR_PT_filter(Panel):
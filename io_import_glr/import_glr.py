@@ -1,9 +1,17 @@
 import os
+import mmap
 import struct
 import bpy
 import bmesh
 import hashlib
-from .shader import setup_n64_material
+import numpy as np
+from numpy.lib.recfunctions import repack_fields
+from .shader import (
+    new_n64_material,
+    get_images_by_filepath,
+    list_texture_files,
+    TextureInfo,
+)
 from .utils import (
     get_texture_filter,
     get_backface_culling,
@@ -12,6 +20,58 @@ from .utils import (
 )
 
 
+# magic, version, romname, num_tris, microcode
+HEADER_STRUCT = struct.Struct('<6sH20sII')
+
+# On-disk layout of a triangle: three vertices followed by the RDP
+# state that was active when the triangle was drawn
+VERTEX_DTYPE = np.dtype([
+    ('co', '<f4', 3),
+    ('color', '<f4', 4),
+    ('uv0', '<f4', 2),
+    ('uv1', '<f4', 2),
+])
+
+TRIANGLE_DTYPE = np.dtype([
+    ('verts', VERTEX_DTYPE, 3),
+    ('fog_color', '<f4', 4),
+    ('blend_color', '<f4', 4),
+    ('env_color', '<f4', 4),
+    ('prim_color', '<f4', 4),
+    ('prim_l', '<f4'), ('prim_m', '<f4'),
+    ('fog_multiplier', '<f4'), ('fog_offset', '<f4'),
+    ('k4', '<i4'), ('k5', '<i4'),
+    ('combiner_mux', '<u8'),
+    ('other_mode', '<u8'),
+    ('geometry_mode', '<u4'),
+    ('tex0_crc', '<u8'),
+    ('tex0_clampS', '<f4'), ('tex0_clampT', '<f4'),
+    ('tex0_wrapS', '<f4'), ('tex0_wrapT', '<f4'),
+    ('tex0_mirrorS', 'u1'), ('tex0_mirrorT', 'u1'),
+    ('tex0_pad', 'V2'),
+    ('tex1_crc', '<u8'),
+    ('tex1_clampS', '<f4'), ('tex1_clampT', '<f4'),
+    ('tex1_wrapS', '<f4'), ('tex1_wrapT', '<f4'),
+    ('tex1_mirrorS', 'u1'), ('tex1_mirrorT', 'u1'),
+    ('tex1_pad', 'V2'),
+])
+
+# Fields of a triangle that determine its material
+MATINFO_FIELDS = (
+    'combiner_mux',
+    'other_mode',
+    'geometry_mode',
+    'tex0_crc',
+    'tex0_clampS', 'tex0_clampT',
+    'tex0_wrapS', 'tex0_wrapT',
+    'tex0_mirrorS', 'tex0_mirrorT',
+    'tex1_crc',
+    'tex1_clampS', 'tex1_clampT',
+    'tex1_wrapS', 'tex1_wrapT',
+    'tex1_mirrorS', 'tex1_mirrorT',
+)
+
+
 ### Import Plugin Entry Point
 def load(context, **keywords):
     if keywords['files']:
@@ -30,37 +90,45 @@ def load(context, **keywords):
             'enable_bf_culling',
             'enable_fog',
             'filter_mode',
+            'merge_doubles',
+            'build_nodes',
+            'debug_props',
+            'emit_frames',
         ]
     }
     triangle_options['filter_list'] = filter_list
+    triangle_options['merge_distance'] = round(keywords['merge_distance'], 6)  # chopping off extra precision
+
+    # Materials are shared between all the files in this import
+    triangle_options['material_cache'] = {}
+    triangle_options['materials_by_name'] = {mat.name: mat for mat in bpy.data.materials}
+    # So are the images, and the listing of the texture directory (all
+    # the files are in the same one)
+    triangle_options['image_cache'] = get_images_by_filepath()
+    if keywords['build_nodes']:
+        triangle_options['texture_files'] = list_texture_files(os.path.abspath(dir_name))
 
     # Deselect everything; after import, only imported objects will be
     # selected
     if bpy.ops.object.select_all.poll():
         bpy.ops.object.select_all(action='DESELECT')
 
+    objs = []
     for glr_file in files:
         filepath = os.path.join(dir_name, glr_file)
         ob = load_glr(filepath, **triangle_options)
 
         context.scene.collection.objects.link(ob)
 
-        ob.select_set(True)
-
         ob.location = context.scene.cursor.location
         ob.scale = (keywords['scale'],) * 3
 
-        if keywords['merge_doubles']:
-            ob_mesh = ob.data
-            bm = bmesh.new()
-            bm.from_mesh(ob_mesh)
-            merge_distance = round(keywords['merge_distance'], 6)  # chopping off extra precision
-            bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=merge_distance)
-            bm.to_mesh(ob_mesh)
-            bm.free()
+        objs.append(ob)
 
-    # Make the last object active
-    context.view_layer.objects.active = ob
+    # Select the imported objects and make the last one active
+    for ob in objs:
+        ob.select_set(True)
+    context.view_layer.objects.active = objs[-1]
 
     # Checking and enabling Color Management options
     if keywords['enable_srgb']:
@@ -80,9 +148,11 @@ def parse_filter_list(filter_str):
                 x = 0 if x == 'NO_TEXTURE' else int(x, 16)
             except ValueError:
                 raise ValueError('Invalid value in filter list:', x)
+            if not 0 <= x < 2**64:  # CRCs are 64-bit
+                raise ValueError('Invalid value in filter list:', hex(x))
             filter_list.add(x)
 
-    return filter_list
+    return frozenset(filter_list)
 
 
 def load_glr(filepath, **triangle_options):
@@ -91,6 +161,39 @@ def load_glr(filepath, **triangle_options):
         return GlrImporter(fb, texture_dir, **triangle_options).load()
 
 
+# Names of the materials made for each material cache key, kept across
+# imports. Names are stored instead of the Materials themselves because
+# a bpy reference can outlive the data it points to (eg. after loading
+# another .blend), and touching it then may crash Blender.
+MATERIAL_NAMES = {}
+
+
+def weld_vertices(positions):
+    """
+    Finds groups of vertices at exactly the same position to merge
+    together.
+
+    Returns the index of the merged vertex each input vertex belongs
+    to, and for each merged vertex, the index of the input vertex
+    whose position it takes. Merged vertices are numbered in order of
+    first use, so merging by distance afterwards visits them in the
+    same order as the unmerged verts. The result is equivalent, not
+    identical: in clusters wider than the distance it may keep other
+    vertices, but no two end up within the distance of each other and
+    each merged vertex is within it of its target.
+    """
+    keys = np.ascontiguousarray(positions + np.float32(0))  # so -0.0 matches 0.0
+    _, firsts, ids = np.unique(
+        keys.view(f'V{keys.itemsize * 3}').ravel(),
+        return_index=True,
+        return_inverse=True,
+    )
+    order = np.argsort(firsts)
+    renumber = np.empty_like(order)
+    renumber[order] = np.arange(len(order))
+    return renumber[ids.ravel()], firsts[order]
+
+
 class GlrImporter:
     def __init__(
         self,
@@ -101,6 +204,15 @@ class GlrImporter:
         enable_fog=True,
         filter_mode=True,
         filter_list='',
+        merge_doubles=False,
+        merge_distance=0.0,
+        build_nodes=True,
+        debug_props=True,
+        emit_frames=True,
+        material_cache=None,
+        materials_by_name=None,
+        image_cache=None,
+        texture_files=None,
     ):
         if isinstance(filter_list, str):
             filter_list = parse_filter_list(filter_list)
@@ -111,24 +223,69 @@ class GlrImporter:
         self.display_culling = enable_bf_culling
         self.filter_mode = filter_mode
         self.filter_list = filter_list
+        self.filter_crcs = np.fromiter(filter_list, dtype=np.uint64, count=len(filter_list))
         self.enable_fog = enable_fog
+        self.merge_doubles = merge_doubles
+        self.merge_distance = merge_distance
+        self.build_nodes = build_nodes
+        self.debug_props = debug_props
+        self.emit_frames = emit_frames
+        # bpy.data.materials lookups by name are a linear scan. Like
+        # material_cache, this can be shared by the files in one import.
+        if materials_by_name is None:
+            materials_by_name = {mat.name: mat for mat in bpy.data.materials}
+        self.materials_by_name = materials_by_name
+        # Maps material info to an already created material. Only share
+        # this within one import: holding on to Materials any longer
+        # risks using them after they have been removed.
+        self.material_cache = {} if material_cache is None else material_cache
+        # Images by filepath, and the texture files that exist, so
+        # missing ones can skip trying to load (only needed for images
+        # in node trees). Also shared within one import.
+        if image_cache is None:
+            image_cache = get_images_by_filepath()
+        self.image_cache = image_cache
+        if texture_files is None and build_nodes:
+            texture_files = list_texture_files(texture_dir)
+        self.texture_files = texture_files
+        # Materials to copy the node tree of, by node setup
+        self.shader_templates = {}
+        self.buf = None
         self.obj_name = None
         self.num_tris = None
         self.microcode = None
 
     def load(self):
+        # Map the file once; the header and the triangles are both
+        # parsed straight out of the mapping. The mapping is released
+        # once the last array viewing it is gone.
+        try:
+            self.buf = mmap.mmap(self.fb.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            raise RuntimeError('Not a valid glr file')
+
         self.load_header()
         return self.do_tris()
 
     def load_header(self):
         fb = self.fb
+        buf = self.buf
+
+        if len(buf) < HEADER_STRUCT.size:
+            raise RuntimeError('Not a valid glr file')
+        (
+            magic,
+            version,
+            romname,
+            self.num_tris,
+            self.microcode,
+        ) = HEADER_STRUCT.unpack_from(buf, 0)
 
         # Check magic
-        if fb.read(6) != b'GL64R\0':
+        if magic != b'GL64R\0':
             raise RuntimeError('Not a valid glr file')
 
         # Check version
-        version = struct.unpack('<H', fb.read(2))[0]
         expected_version = 4
         if version < expected_version:
             raise RuntimeError(
@@ -143,140 +300,154 @@ class GlrImporter:
                 'You should update this addon.'
             )
 
-        romname = fb.read(20)
         romname = romname.decode(errors='replace')
         romname = romname.replace('\0', '').strip()
         romname = romname or 'Unknown N64 Game'
         self.obj_name = romname + ' (' + os.path.basename(fb.name)[:-4] + ')'
 
-        self.num_tris = struct.unpack('<I', fb.read(4))[0]
-        self.microcode = struct.unpack('<I', fb.read(4))[0]
-
     def do_tris(self):
-        fb = self.fb
+        # Triangles follow the header
+        expected_size = HEADER_STRUCT.size + self.num_tris * TRIANGLE_DTYPE.itemsize
+        if len(self.buf) < expected_size:
+            raise RuntimeError(
+                f'GLR file is truncated: expected {self.num_tris} triangles '
+                f'({expected_size} bytes), but the file is only {len(self.buf)} bytes.'
+            )
+        tris = np.frombuffer(
+            self.buf,
+            dtype=TRIANGLE_DTYPE,
+            count=self.num_tris,
+            offset=HEADER_STRUCT.size,
+        )
 
-        verts = []
-        faces = []
-        shade_colors = []
-        prim_colors = []
-        env_colors = []
-        blend_colors = []
-        fog_colors = []
-        fog_levels = []
-        prim_lods = []
-        uvs0 = []
-        uvs1 = []
-
-        matinfo_cache = {}
-        face_materials = []
-
-        for i in range(self.num_tris):
-            # Read vertices
-            tri_verts = [fb.read(44) for _ in range(3)]
-
-            # Read triangle data
-            (
-                fog_r, fog_g, fog_b, fog_a,
-                blend_r, blend_g, blend_b, blend_a,
-                env_r, env_g, env_b, env_a,
-                prim_r, prim_g, prim_b, prim_a,
-                prim_l, prim_m,
-                fog_multiplier, fog_offset,
-                k4, k5,
-                combiner_mux,
-                other_mode,
-                geometry_mode,
-                tex0_crc,
-                tex0_clampS, tex0_clampT,
-                tex0_wrapS, tex0_wrapT,
-                tex0_mirrorS, tex0_mirrorT,
-                tex1_crc,
-                tex1_clampS, tex1_clampT,
-                tex1_wrapS, tex1_wrapT,
-                tex1_mirrorS, tex1_mirrorT,
-            ) = struct.unpack('<4f4f4f4f2f2f2iQQIQ2f2f2BxxQ2f2f2Bxx', fb.read(164))
-
-            # Skip tris blacklisted by their texture CRC
-            blacklisted = tex0_crc in self.filter_list
-            if not self.filter_mode:  # Whitelist mode
-                blacklisted = not blacklisted
-            if blacklisted:
-                continue
-
-            # Process vertices
-            for vert in tri_verts:
-                (
-                    x, y, z, r, g, b, a, s0, t0, s1, t1,
-                ) = struct.unpack('<11f', vert)
-
-                shade_colors += [r, g, b, a]
-                uvs0 += [s0, 1 - t0]      # Flip UV
-                uvs1 += [s1, 1 - t1]      # Flip UV
-                verts.append((x, -z, y))  # Yup2Zup
-
-                # When fog enabled, alpha is the fog level
-                fog_levels.append(a if geometry_mode & 0x10000 else 0)
-
-            # Store per-tri colors as vertex colors (once per corner)
-            prim_colors += [prim_r, prim_g, prim_b, prim_a] * 3
-            env_colors += [env_r, env_g, env_b, env_a] * 3
-            blend_colors += [blend_r, blend_g, blend_b, blend_a] * 3
-            fog_colors += [fog_r, fog_g, fog_b, fog_a] * 3
-
-            # Primitive LOD fraction (once per face)
-            prim_lods.append(prim_l)
-
-            faces.append((len(verts) - 3, len(verts) - 2, len(verts) - 1))
-
-            # Gather all the info we need to make the material for this tri
-            matinfo = (
-                combiner_mux,
-                other_mode,
-                geometry_mode,
-                tex0_crc,
-                tex0_clampS, tex0_clampT,
-                tex0_wrapS, tex0_wrapT,
-                tex0_mirrorS, tex0_mirrorT,
-                tex1_crc,
-                tex1_clampS, tex1_clampT,
-                tex1_wrapS, tex1_wrapT,
-                tex1_mirrorS, tex1_mirrorT,
+        # Skip tris blacklisted by their texture CRC
+        # (in whitelist mode, skip tris NOT in the list)
+        if self.filter_list or not self.filter_mode:
+            listed = np.isin(tris['tex0_crc'], self.filter_crcs)
+            tris = tris[listed != self.filter_mode]
+
+        num_tris = len(tris)
+        tri_verts = tris['verts']
+
+        # Process vertices
+        # Per-vertex buffers are allocated once as (tri, corner, component)
+        # so columns can be copied straight out of the triangle records.
+        verts = np.empty((num_tris, 3, 3), dtype=np.float32)  # Yup2Zup
+        verts[..., 0] = tri_verts['co'][..., 0]
+        np.negative(tri_verts['co'][..., 2], out=verts[..., 1])
+        verts[..., 2] = tri_verts['co'][..., 1]
+
+        # Merge doubles
+        # Exact duplicates (by far the most common, since every tri has
+        # its own copy of its verts) are welded here; merging by
+        # distance happens once the mesh is built.
+        if self.merge_doubles:
+            vert_ids, vert_firsts = weld_vertices(verts.reshape(-1, 3))
+
+            # Skip tris that collapse to a line or a point
+            corners = vert_ids.reshape(-1, 3)
+            collapsed = (
+                (corners[:, 0] == corners[:, 1]) |
+                (corners[:, 1] == corners[:, 2]) |
+                (corners[:, 2] == corners[:, 0])
             )
-            material_index = matinfo_cache.setdefault(matinfo, len(matinfo_cache))
-            face_materials.append(material_index)
+            if collapsed.any():
+                tris = tris[~collapsed]
+                verts = verts[~collapsed]
+                num_tris = len(tris)
+                tri_verts = tris['verts']
+                vert_ids, vert_firsts = weld_vertices(verts.reshape(-1, 3))
+
+        shade_colors = tri_verts['color'].ravel()
+        uvs0 = np.empty((num_tris, 3, 2), dtype=np.float32)
+        uvs0[..., 0] = tri_verts['uv0'][..., 0]
+        np.subtract(1, tri_verts['uv0'][..., 1], out=uvs0[..., 1])  # Flip UV
+        uvs1 = np.empty((num_tris, 3, 2), dtype=np.float32)
+        uvs1[..., 0] = tri_verts['uv1'][..., 0]
+        np.subtract(1, tri_verts['uv1'][..., 1], out=uvs1[..., 1])  # Flip UV
+
+        # When fog enabled, alpha is the fog level
+        fog_levels = None
+        if self.enable_fog:
+            fog_enabled = (tris['geometry_mode'] & 0x10000) != 0
+            if fog_enabled.any():
+                fog_levels = np.where(
+                    fog_enabled[:, None], tri_verts['color'][:, :, 3], 0,
+                ).ravel()
+
+        # Primitive LOD fraction (once per face)
+        prim_lods = np.ascontiguousarray(tris['prim_l'])
+
+        # Gather all the info we need to make the material for each tri.
+        # The fields are packed and deduplicated as raw bytes, which is
+        # much cheaper to sort than field-by-field. Materials are
+        # numbered in order of first use.
+        matinfos = repack_fields(tris[list(MATINFO_FIELDS)])
+        _, first_use, face_materials = np.unique(
+            matinfos.view(f'V{matinfos.itemsize}'),
+            return_index=True,
+            return_inverse=True,
+        )
+        order = np.argsort(first_use)
+        material_slots = np.empty_like(order)
+        material_slots[order] = np.arange(len(order))
+        face_materials = material_slots[face_materials].astype(np.int32)
+        matinfos = matinfos[first_use[order]].tolist()
+
+        # Unless merged, every tri has its own three verts, so loop i
+        # uses vertex i
+        verts = verts.reshape(-1, 3)
+        if self.merge_doubles:
+            verts = verts[vert_firsts]
+            loop_verts = vert_ids.astype(np.int32)
+            if fog_levels is not None:
+                fog_levels = fog_levels[vert_firsts]
+        else:
+            loop_verts = np.arange(3 * num_tris, dtype=np.int32)
 
         # Create mesh
+        # (this is what from_pydata does, minus the Python iteration)
         mesh = bpy.data.meshes.new(self.obj_name)
-        mesh.from_pydata(verts, [], faces)
+        mesh.vertices.add(len(verts))
+        mesh.attributes['position'].data.foreach_set('vector', verts.ravel())
+        mesh.loops.add(3 * num_tris)
+        mesh.loops.foreach_set('vertex_index', loop_verts)
+        mesh.polygons.add(num_tris)
+        mesh.polygons.foreach_set('loop_start', np.arange(0, 3 * num_tris, 3, dtype=np.int32))
+        if bpy.app.version < (4, 0, 0):
+            mesh.polygons.foreach_set('loop_total', np.full(num_tris, 3, dtype=np.int32))
+        if bpy.app.version >= (4, 1, 0):
+            mesh.shade_flat()
+        mesh.update(calc_edges=True)
 
         # Create & assign materials
-        for matinfo in matinfo_cache:
+        for matinfo in matinfos:
             mesh.materials.append(self.create_material(matinfo))
         mesh.polygons.foreach_set('material_index', face_materials)
 
         # Create attributes
+        # NOTE: foreach_set only takes the fast memcpy path when passed a
+        # contiguous buffer of the right type (float32 or int32), so keep
+        # all the buffers above that way.
 
         mesh.vertex_colors.new(
             name='Shade Color'
         ).data.foreach_set('color', shade_colors)
 
-        mesh.vertex_colors.new(
-            name='Primitive Color',
-        ).data.foreach_set('color', prim_colors)
-
-        mesh.vertex_colors.new(
-            name='Env Color',
-        ).data.foreach_set('color', env_colors)
-
-        mesh.vertex_colors.new(
-            name='Blend Color',
-        ).data.foreach_set('color', blend_colors)
-
-        mesh.vertex_colors.new(
-            name='Fog Color',
-        ).data.foreach_set('color', fog_colors)
-
-        if self.enable_fog and any(fog_levels):
+        # Store per-tri colors as vertex colors (once per corner). Each
+        # is repeated just before it is written so only one of these
+        # buffers is alive at a time.
+        for name, field in [
+            ('Primitive Color', 'prim_color'),
+            ('Env Color', 'env_color'),
+            ('Blend Color', 'blend_color'),
+            ('Fog Color', 'fog_color'),
+        ]:
+            mesh.vertex_colors.new(
+                name=name,
+            ).data.foreach_set('color', np.repeat(tris[field], 3, axis=0).ravel())
+
+        if fog_levels is not None and fog_levels.any():
             mesh.attributes.new(
                 name='Fog Level', type='FLOAT', domain='POINT',
             ).data.foreach_set('value', fog_levels)
@@ -285,10 +456,25 @@ class GlrImporter:
             name='Primitive LOD', type='FLOAT', domain='FACE',
         ).data.foreach_set('value', prim_lods)
 
-        mesh.uv_layers.new(name='UV0').data.foreach_set('uv', uvs0)
-        mesh.uv_layers.new(name='UV1').data.foreach_set('uv', uvs1)
+        mesh.uv_layers.new(name='UV0').data.foreach_set('uv', uvs0.ravel())
+        mesh.uv_layers.new(name='UV1').data.foreach_set('uv', uvs1.ravel())
 
-        mesh.validate()
+        # Every index above was generated here, so the mesh is valid by
+        # construction, except that merging can weld two tris onto the
+        # same three verts. All layers were filled from our own buffers,
+        # so there is no custom data to clean up.
+        if self.merge_doubles:
+            mesh.validate(clean_customdata=False)
+
+        # Merge the verts that are close but not exactly equal. The
+        # mesh has already shrunk to its unique verts, so this is much
+        # cheaper than on the raw tris.
+        if self.merge_doubles and self.merge_distance > 0:
+            bm = bmesh.new()
+            bm.from_mesh(mesh)
+            bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=self.merge_distance)
+            bm.to_mesh(mesh)
+            bm.free()
 
         # Create object
         ob = bpy.data.objects.new(mesh.name, mesh)
@@ -296,6 +482,27 @@ class GlrImporter:
         return ob
 
     def create_material(self, matinfo):
+        # Everything besides matinfo that affects the material
+        cache_key = (
+            matinfo,
+            self.microcode,
+            self.display_culling,
+            self.show_alpha,
+            self.build_nodes,
+            self.debug_props,
+            self.emit_frames,
+        )
+        mat = self.material_cache.get(cache_key)
+        if mat is not None:
+            return mat
+
+        # Reuse a material made by an earlier import, if it's still
+        # around
+        mat = self.materials_by_name.get(MATERIAL_NAMES.get(cache_key))
+        if mat is not None:
+            self.material_cache[cache_key] = mat
+            return mat
+
         (
             combiner_mux,
             other_mode,
@@ -327,24 +534,21 @@ class GlrImporter:
         if not two_cycle_mode:
             combiner2 = blender2 = None
 
-        tex0, tex1 = [
-            {
-                'crc': crc,
-                'filter': get_texture_filter(other_mode),
-                'clampS': clampS,
-                'clampT': clampT,
-                'wrapS': wrapS,
-                'wrapT': wrapT,
-                'mirrorS': mirrorS,
-                'mirrorT': mirrorT,
-            }
-            for crc, clampS, clampT, wrapS, wrapT, mirrorS, mirrorT in [
-                (tex0_crc, tex0_clampS, tex0_clampT, tex0_wrapS, tex0_wrapT, tex0_mirrorS, tex0_mirrorT),
-                (tex1_crc, tex1_clampS, tex1_clampT, tex1_wrapS, tex1_wrapT, tex1_mirrorS, tex1_mirrorT),
-            ]
-        ]
-        tex0['uv_map'] = 'UV0'
-        tex1['uv_map'] = 'UV1'
+        tex_filter = get_texture_filter(other_mode)
+        tex0 = TextureInfo(
+            tex0_crc, tex_filter,
+            tex0_clampS, tex0_clampT,
+            tex0_wrapS, tex0_wrapT,
+            tex0_mirrorS, tex0_mirrorT,
+            'UV0',
+        )
+        tex1 = TextureInfo(
+            tex1_crc, tex_filter,
+            tex1_clampS, tex1_clampT,
+            tex1_wrapS, tex1_wrapT,
+            tex1_mirrorS, tex1_mirrorT,
+            'UV1',
+        )
 
         cull_backface = get_backface_culling(geometry_mode, self.microcode)
         cull_backface &= self.display_culling
@@ -397,13 +601,35 @@ class GlrImporter:
             self.show_alpha,
         )
 
-        mat_hash = hashlib.sha256(str(args).encode()).hexdigest()[:16]
+        # The name must be stable across sessions and versions so
+        # re-imports reuse existing materials, which rules out the
+        # builtin hash(). Textures are hashed as the dicts they used to
+        # be, which keeps the names the same as earlier versions made.
+        # Options that change the material but aren't in args go in the
+        # hash too, so those materials don't get mixed up.
+        name_args = (*args[:4], tex0._asdict(), tex1._asdict(), *args[6:])
+        if not self.build_nodes:
+            name_args += ('No Nodes',)
+        if not self.debug_props:
+            name_args += ('No Debug Props',)
+        if not self.emit_frames and self.build_nodes:
+            name_args += ('No Frames',)
+        mat_hash = hashlib.sha256(str(name_args).encode()).hexdigest()[:16]
         mat_name = f'N64 Shader {mat_hash}'
 
-        if mat_name in bpy.data.materials:
-            mat = bpy.data.materials[mat_name]
-        else:
-            mat = bpy.data.materials.new(mat_name)
-            setup_n64_material(mat, self.texture_dir, *args)
+        mat = self.materials_by_name.get(mat_name)
+        if mat is None:
+            mat = new_n64_material(
+                mat_name, self.texture_dir, *args,
+                image_cache=self.image_cache,
+                templates=self.shader_templates,
+                build_nodes=self.build_nodes,
+                debug_props=self.debug_props,
+                emit_frames=self.emit_frames,
+                texture_files=self.texture_files,
+            )
+            self.materials_by_name[mat_name] = mat
 
+        MATERIAL_NAMES[cache_key] = mat.name
+        self.material_cache[cache_key] = mat
         return mat
@@ -1,5 +1,8 @@
 import bpy
 import os
+from collections import namedtuple
+from functools import lru_cache
+from itertools import chain
 from .utils import (
     show_combiner_formula,
     show_blender_formula,
@@ -71,22 +74,119 @@ from .utils import (
 # Angrylion's RDP Plus
 
 
-def setup_n64_material(material, texture_dir, *args):
-    return N64Shader(material, texture_dir).setup(*args)
+# Everything about a texture unit the material needs
+TextureInfo = namedtuple('TextureInfo', [
+    'crc',
+    'filter',
+    'clampS', 'clampT',
+    'wrapS', 'wrapT',
+    'mirrorS', 'mirrorT',
+    'uv_map',
+])
+
+# Socket indices of a ShaderNodeMix in RGBA mode (the float and vector
+# modes have their own A/B/Result sockets at other indices)
+MIX_FAC = 0
+MIX_COLOR_A = 6
+MIX_COLOR_B = 7
+MIX_COLOR_RESULT = 2
+
+
+def new_n64_material(
+    name, texture_dir, *args,
+    image_cache=None, templates=None, build_nodes=True, debug_props=True,
+    emit_frames=True, texture_files=None,
+):
+    """
+    Creates a new material and sets it up.
+
+    Building the node tree is the slow part of making a material, and
+    lots of materials only differ in their textures. So the first
+    material made for each node setup is kept in templates, and later
+    ones are copies of it with their own images swapped in.
+
+    With build_nodes=False, no node tree is made at all; the material
+    only gets its settings and custom props. With debug_props=False,
+    the custom props are left out, and with emit_frames=False, the
+    frames labeling groups of nodes.
+    """
+    if not build_nodes:
+        material = bpy.data.materials.new(name)
+        N64Shader(
+            material, texture_dir, image_cache,
+            build_nodes=False, debug_props=debug_props,
+        ).setup(*args)
+        return material
+
+    combiner1, combiner2, blender1, blender2, tex0, tex1 = args[:6]
+    key = (
+        combiner1, combiner2,
+        blender1, blender2,
+        tex0._replace(crc=None), tex1._replace(crc=None),
+    )
+
+    template = templates.get(key) if templates is not None else None
+    if template is None:
+        material = bpy.data.materials.new(name)
+        shader = N64Shader(
+            material, texture_dir, image_cache,
+            debug_props=debug_props, emit_frames=emit_frames,
+            texture_files=texture_files,
+        )
+        shader.setup(*args)
+        if templates is not None:
+            templates[key] = material, shader.use_alpha
+    else:
+        template, use_alpha = template
+        material = template.copy()
+        material.name = name
+        shader = N64Shader(
+            material, texture_dir, image_cache,
+            debug_props=debug_props, emit_frames=emit_frames,
+            texture_files=texture_files,
+        )
+        shader.use_alpha = use_alpha
+        shader.set_textures(tex0, tex1)
+        shader.setup_material(*args)
+
+    return material
 
 
 class N64Shader:
-    def __init__(self, material, texture_dir):
+    def __init__(
+        self, material, texture_dir, image_cache=None,
+        build_nodes=True, debug_props=True, emit_frames=True,
+        texture_files=None,
+    ):
         self.material = material
         self.texture_dir = texture_dir
-
-        material.use_nodes = True
-        self.node_tree = material.node_tree
-        self.nodes = material.node_tree.nodes
-        self.links = material.node_tree.links
+        # Maps absolute texture filepaths to images (see
+        # get_images_by_filepath); can be shared between materials to
+        # skip repeat bpy.data.images lookups
+        self.image_cache = {} if image_cache is None else image_cache
+        # Lowercased file names in texture_dir (see list_texture_files),
+        # or None to try loading every texture
+        self.texture_files = texture_files
+        self.build_nodes = build_nodes
+        self.debug_props = debug_props
+        # Whether to put frames with labels around groups of nodes.
+        # They are only there to make the node tree easier to read.
+        self.emit_frames = emit_frames
+
+        if build_nodes:
+            material.use_nodes = True
+            self.node_tree = material.node_tree
+            self.nodes = material.node_tree.nodes
+            self.links = material.node_tree.links
+            # Bound once; resolving these through RNA on every call adds up
+            # over the dozens of nodes each material gets
+            self.new_node = self.nodes.new
+            self.new_link = self.links.new
 
         self.use_alpha = False
         self.vars = {'0': 0, '1': 1}
+        # X position for the next block of nodes
+        self.next_x = -630
 
     def setup(
         self,
@@ -97,23 +197,45 @@ class N64Shader:
         is_translucent,
         show_alpha,
     ):
-        mat = self.material
-
-        self.nodes.clear()
-
-        # Gather all input sources the shader needs
-        sources = []
-        sources += combiner1
-        sources += combiner2 or []
-        sources += blender1
-        sources += blender2 or []
+        if self.build_nodes:
+            self.nodes.clear()
+
+            # Gather all input sources the shader needs (each once, in
+            # order of first use)
+            sources = dict.fromkeys(chain(
+                combiner1, combiner2 or (),
+                blender1, blender2 or (),
+            ))
+
+            self.make_inputs(tex0, tex1, sources)
+            self.make_combiners(combiner1, combiner2)
+            self.make_blenders(blender1, blender2)
+            self.make_output()
+        else:
+            self.use_alpha = needs_alpha_blending(combiner1, combiner2, blender1, blender2)
+
+        self.setup_material(
+            combiner1, combiner2,
+            blender1, blender2,
+            tex0, tex1,
+            cull_backfacing,
+            is_translucent,
+            show_alpha,
+        )
 
-        self.make_inputs(tex0, tex1, sources)
-        self.make_combiners(combiner1, combiner2)
-        self.make_blenders(blender1, blender2)
-        self.make_output()
+    def setup_material(
+        self,
+        combiner1, combiner2,
+        blender1, blender2,
+        tex0, tex1,
+        cull_backfacing,
+        is_translucent,
+        show_alpha,
+    ):
+        # Called after the nodes are made, since it needs
+        # self.use_alpha
+        mat = self.material
 
-        # Set material-level properties
         if bpy.app.version < (4, 2, 0):
             mat.shadow_method = 'NONE'
             if self.use_alpha and show_alpha:
@@ -128,8 +250,10 @@ class N64Shader:
         mat.use_backface_culling = cull_backfacing
 
         # Custom props (useful for debugging)
-        mat['N64 Texture 0'] = show_texture_info(tex0) if tex0['crc'] else ''
-        mat['N64 Texture 1'] = show_texture_info(tex1) if tex1['crc'] else ''
+        if not self.debug_props:
+            return
+        mat['N64 Texture 0'] = show_texture_info(tex0) if tex0.crc else ''
+        mat['N64 Texture 1'] = show_texture_info(tex1) if tex1.crc else ''
         mat['N64 Color Combiner 1'] = show_combiner_formula(*combiner1[:4])
         mat['N64 Alpha Combiner 1'] = show_combiner_formula(*combiner1[4:])
         mat['N64 Color Combiner 2'] = show_combiner_formula(*combiner2[:4]) if combiner2 else ''
@@ -137,6 +261,13 @@ class N64Shader:
         mat['N64 Blender 1'] = show_blender_formula(*blender1)
         mat['N64 Blender 2'] = show_blender_formula(*blender2) if blender2 else ''
 
+    def set_textures(self, tex0, tex1):
+        """Points the Image Texture nodes at the images for tex0/tex1."""
+        for tex_num, tex in enumerate([tex0, tex1]):
+            node_tex = self.nodes.get(f'Texture {tex_num}')
+            if node_tex is not None:
+                node_tex.image = self.load_image(tex.crc)
+
     def connect(self, v, socket):
         """
         Connect a socket to an input source.
@@ -148,45 +279,45 @@ class N64Shader:
             v = self.vars[v]
 
         if isinstance(v, bpy.types.NodeSocket):
-            self.links.new(v, socket)
+            # Every input socket is only connected once, so skip the
+            # check for existing links
+            self.new_link(v, socket, verify_limits=False)
         else:
             if isinstance(v, (int, float)) and socket.type == 'RGBA':
                 v = (v, v, v, 1.0)
             socket.default_value = v
 
+    def connect_socket(self, output, socket):
+        """Like connect, for when the source is known to be a socket."""
+        self.new_link(output, socket, verify_limits=False)
+
     def new_color_math_node(self, blend_type):
         """
         Creates a node for color math.
 
         Returns the node, the two input sockets, and the output socket.
         """
-        node = self.nodes.new('ShaderNodeMix')
+        node = self.new_node('ShaderNodeMix')
         node.data_type = 'RGBA'
         node.blend_type = blend_type
-        node.inputs[0].default_value = 1  # Fac
-        return node, node.inputs[6], node.inputs[7], node.outputs[2]
+        inputs = node.inputs
+        inputs[MIX_FAC].default_value = 1
+        return node, inputs[MIX_COLOR_A], inputs[MIX_COLOR_B], node.outputs[MIX_COLOR_RESULT]
 
     def get_next_x_position(self):
         """
         Get the X position to put the next block of nodes at.
 
         Blocks are created from left to right following the path of
-        the "Combined Color" and "Combined Alpha" variables. Gets a
-        point to the right of those sockets.
+        the "Combined Color" and "Combined Alpha" variables. Every node
+        placed on that path calls advance_x, so this is just a point to
+        the right of the rightmost one so far.
         """
-        # Start position
-        locs = [-630]
-
-        for arg in ['Combined Color', 'Combined Alpha']:
-            if arg not in self.vars:
-                continue
-            if not isinstance(self.vars[arg], bpy.types.NodeSocket):
-                continue
-            x = self.vars[arg].node.location[0]
-            x += 300  # move node width + gutter
-            locs.append(x)
+        return self.next_x
 
-        return max(locs)
+    def advance_x(self, x):
+        # Move past a node at x (node width + gutter)
+        self.next_x = max(self.next_x, x + 300)
 
     def make_combiners(self, combiner1, combiner2):
         x = self.get_next_x_position()
@@ -211,6 +342,7 @@ class N64Shader:
             node = self.make_simple_blender_mix_node(blender)
             if node:
                 node.location = x, y
+                self.advance_x(x)
                 x += 320
 
             # The only blend mode we can do in Blender is alpha
@@ -226,41 +358,38 @@ class N64Shader:
 
     def make_output(self):
         x = self.get_next_x_position()
-        node_emission = self.nodes.new('ShaderNodeEmission')
+        node_emission = self.new_node('ShaderNodeEmission')
         node_emission.location = x, 160
+        self.connect('Combined Color', node_emission.inputs[0])
+        node = node_emission
 
         # If the shader needs alpha blending, combine the color and
         # alpha with a Transparent BSDF + Mix Shader.
         if self.use_alpha:
-            node_mix = self.nodes.new('ShaderNodeMixShader')
-            node_trans = self.nodes.new('ShaderNodeBsdfTransparent')
-
-            node_mix.location = x + 200, 300
+            node_trans = self.new_node('ShaderNodeBsdfTransparent')
             node_trans.location = x, 400
-            node_emission.location = x, 160
-            x += 500
 
-            self.connect('Combined Alpha', node_mix.inputs[0])
-            self.connect(node_trans.outputs[0], node_mix.inputs[1])
-            self.connect(node_emission.outputs[0], node_mix.inputs[2])
-            self.connect('Combined Color', node_emission.inputs[0])
+            node = self.new_node('ShaderNodeMixShader')
+            node.location = x + 200, 300
+            x += 200
 
-        node_out = self.nodes.new('ShaderNodeOutputMaterial')
-        node_out.location = x + 200, 260
-        if self.use_alpha:
-            self.connect(node_mix.outputs[0], node_out.inputs[0])
-        else:
-            self.connect('Combined Color', node_emission.inputs[0])
-            self.connect(node_emission.outputs[0], node_out.inputs[0])
+            self.connect('Combined Alpha', node.inputs[0])
+            self.connect_socket(node_trans.outputs[0], node.inputs[1])
+            self.connect_socket(node_emission.outputs[0], node.inputs[2])
+
+        node_out = self.new_node('ShaderNodeOutputMaterial')
+        node_out.location = x + 250, 260
+        self.connect_socket(node.outputs[0], node_out.inputs[0])
 
     def make_color_combiner(self, combiner, location):
         a, b, c, d = combiner
         x, y = location
 
-        # Early out for (a-b)*0 + d = d
-        if c == '0':
-            if isinstance(self.vars[d], bpy.types.NodeSocket):
-                self.vars['Combined Color'] = self.vars[d]
+        # Early out when the formula reduces to one of its inputs
+        v = fold_combiner(a, b, c, d)
+        if v is not None:
+            if isinstance(self.vars[v], bpy.types.NodeSocket):
+                self.vars['Combined Color'] = self.vars[v]
             else:
                 # Slightly awkward case. self.connect connects scalars
                 # to a Color socket by putting them in the socket's
@@ -269,68 +398,46 @@ class N64Shader:
                 # default_value, it needs to be a real socket, not a
                 # scalar. So in this case we create an RGB node to
                 # supply the constant value.
-                node = self.nodes.new('ShaderNodeRGB')
+                node = self.new_node('ShaderNodeRGB')
                 node.location = x, y
-                self.connect(self.vars[d], node.outputs[0])
+                self.advance_x(x)
+                self.connect(self.vars[v], node.outputs[0])
                 self.vars['Combined Color'] = node.outputs[0]
             return
 
-        frame = self.nodes.new('NodeFrame')
-        frame.label = show_combiner_formula(a, b, c, d)
-
-        # A - B
-        node, in1, in2, out1 = self.new_color_math_node('SUBTRACT')
+        # (A - B) * C + D
+        node = self.new_node('ShaderNodeGroup')
+        node.node_tree = get_node_group('N64 Color Combiner', build_color_combiner_group)
+        node.label = show_combiner_formula(a, b, c, d)
+        node.width = 240
         node.location = x, y
-        node.parent = frame
-        self.connect(a, in1)
-        self.connect(b, in2)
-
-        # * C
-        node, in1, in2, out2 = self.new_color_math_node('MULTIPLY')
-        node.location = x + 230, y - 120
-        node.parent = frame
-        self.connect(out1, in1)
-        self.connect(c, in2)
-
-        # + D
-        node, in1, in2, out3 = self.new_color_math_node('ADD')
-        node.location = x + 460, y - 240
-        node.parent = frame
-        self.connect(out2, in1)
-        self.connect(d, in2)
-
-        self.vars['Combined Color'] = out3
+        self.advance_x(x)
+        for v, socket in zip(combiner, node.inputs):
+            self.connect(v, socket)
+
+        self.vars['Combined Color'] = node.outputs[0]
 
     def make_alpha_combiner(self, combiner, location):
         a, b, c, d = combiner
         x, y = location
 
-        # Early out for (a-b)*0 + d = d
-        if c == '0':
-            self.vars['Combined Alpha'] = self.vars[d]
+        # Early out when the formula reduces to one of its inputs
+        v = fold_combiner(a, b, c, d)
+        if v is not None:
+            self.vars['Combined Alpha'] = self.vars[v]
             return
 
-        frame = self.nodes.new('NodeFrame')
-        frame.label = show_combiner_formula(a, b, c, d)
-
-        # A - B
-        node1 = self.nodes.new('ShaderNodeMath')
-        node1.operation = 'SUBTRACT'
-        node1.location = x + 90, y - 130
-        node1.parent = frame
-        self.connect(a, node1.inputs[0])
-        self.connect(b, node1.inputs[1])
-
-        # * C + D
-        node2 = self.nodes.new('ShaderNodeMath')
-        node2.operation = 'MULTIPLY_ADD'
-        node2.location = x + 370, y - 150
-        node2.parent = frame
-        self.connect(node1.outputs[0], node2.inputs[0])
-        self.connect(c, node2.inputs[1])
-        self.connect(d, node2.inputs[2])
+        # (A - B) * C + D
+        node = self.new_node('ShaderNodeGroup')
+        node.node_tree = get_node_group('N64 Alpha Combiner', build_alpha_combiner_group)
+        node.label = show_combiner_formula(a, b, c, d)
+        node.width = 240
+        node.location = x, y
+        self.advance_x(x)
+        for v, socket in zip(combiner, node.inputs):
+            self.connect(v, socket)
 
-        self.vars['Combined Alpha'] = node2.outputs[0]
+        self.vars['Combined Alpha'] = node.outputs[0]
 
     def make_simple_blender_mix_node(self, blender):
         """
@@ -357,13 +464,13 @@ class N64Shader:
             return None
 
         node, in1, in2, out = self.new_color_math_node('MIX')
-        self.connect(a, node.inputs[0])
+        self.connect(a, node.inputs[MIX_FAC])
         self.connect(m, in1)
         self.connect(p, in2)
         self.vars['Combined Color'] = out
 
-        if a == 'Fog Level':
-            frame = self.nodes.new('NodeFrame')
+        if a == 'Fog Level' and self.emit_frames:
+            frame = self.new_node('NodeFrame')
             frame.label = 'Fog'
             node.parent = frame
 
@@ -377,94 +484,93 @@ class N64Shader:
             if var in self.vars:
                 continue
 
-            # Texture inputs
-            for i in range(2):
-                if var in [f'Texel {i} Color', f'Texel {i} Alpha']:
-                    tex = tex0 if i == 0 else tex1
-                    node = self.make_texture_unit(tex, i, location=(x, y))
-                    y -= 400
-                    self.vars[f'Texel {i} Color'] = node.outputs['Color']
-                    self.vars[f'Texel {i} Alpha'] = node.outputs['Alpha']
-
-            # Vertex Color inputs
-            for vc in ['Shade', 'Primitive', 'Env', 'Blend', 'Fog']:
-                if var in [f'{vc} Color', f'{vc} Alpha']:
-                    node = self.nodes.new('ShaderNodeVertexColor')
-                    node.location = x, y
-                    y -= 200
-                    node.layer_name = f'{vc} Color'
-                    node.name = node.label = f'{vc} Color'
-                    self.vars[f'{vc} Color'] = node.outputs['Color']
-                    self.vars[f'{vc} Alpha'] = node.outputs['Alpha']
-
-            # Scalar attributes
-            if var in ['Fog Level', 'Primitive LOD Fraction']:
-                node = self.nodes.new('ShaderNodeAttribute')
-                node.location = x, y
-                y -= 290
-                if var == 'Fog Level':
-                    node.attribute_name = 'Fog Level'
-                elif var == 'Primitive LOD Fraction':
-                    node.attribute_name = 'Primitive LOD'
-                node.name = node.label = var
-                self.vars[var] = node.outputs['Fac']
-
-            # Use constant 0 for LOD fraction. Usually LOD is used for
-            # mipmapping, and 0 "should" pick the highest detail
-            # level. But certain effects (like Peach's portrait
-            # morphing into Bowser's in SM64) won't work.
-            if var == 'LOD Fraction':
-                node = self.nodes.new('ShaderNodeValue')
-                node.location = x, y
-                y -= 200
-                node.outputs[0].default_value = 0.0
-                node.label = var
-                self.vars[var] = node.outputs[0]
-
-            # Not yet implemented
-            unimplemented = [
-                'Key Center',
-                'Key Scale',
-                'Noise',
-                'Convert K4',
-                'Convert K5',
-            ]
-            for un_var in unimplemented:
-                if var == un_var:
-                    print('GLR Import: unimplemented color combiner input:', un_var)
-                    node = self.nodes.new('ShaderNodeRGB')
-                    node.location = x, y
-                    y -= 300
-                    node.outputs[0].default_value = (0.0, 1.0, 1.0, 1.0)
-                    node.label = f'{un_var} (UNIMPLEMENTED)'
-                    self.vars[un_var] = node.outputs[0]
+            make_input, arg = INPUT_MAKERS.get(var, (None, None))
+            if make_input:
+                y -= make_input(self, var, arg, [tex0, tex1], location=(x, y))
+
+    # The make_*_input methods make the nodes for an input source and
+    # return how much vertical space they took up
+
+    def make_texel_input(self, var, tex_num, textures, location):
+        node = self.make_texture_unit(textures[tex_num], tex_num, location)
+        self.vars[f'Texel {tex_num} Color'] = node.outputs['Color']
+        self.vars[f'Texel {tex_num} Alpha'] = node.outputs['Alpha']
+        return 400
+
+    def make_vertex_color_input(self, var, vc, textures, location):
+        node = self.new_node('ShaderNodeVertexColor')
+        node.location = location
+        node.layer_name = f'{vc} Color'
+        node.name = node.label = f'{vc} Color'
+        self.vars[f'{vc} Color'] = node.outputs['Color']
+        self.vars[f'{vc} Alpha'] = node.outputs['Alpha']
+        return 200
+
+    def make_attribute_input(self, var, attribute_name, textures, location):
+        node = self.new_node('ShaderNodeAttribute')
+        node.location = location
+        node.attribute_name = attribute_name
+        node.name = node.label = var
+        self.vars[var] = node.outputs['Fac']
+        return 290
+
+    def make_lod_fraction_input(self, var, arg, textures, location):
+        # Use constant 0 for LOD fraction. Usually LOD is used for
+        # mipmapping, and 0 "should" pick the highest detail
+        # level. But certain effects (like Peach's portrait
+        # morphing into Bowser's in SM64) won't work.
+        node = self.new_node('ShaderNodeValue')
+        node.location = location
+        node.outputs[0].default_value = 0.0
+        node.label = var
+        self.vars[var] = node.outputs[0]
+        return 200
+
+    def make_unimplemented_input(self, var, arg, textures, location):
+        print('GLR Import: unimplemented color combiner input:', var)
+        node = self.new_node('ShaderNodeRGB')
+        node.location = location
+        node.outputs[0].default_value = (0.0, 1.0, 1.0, 1.0)
+        node.label = f'{var} (UNIMPLEMENTED)'
+        self.vars[var] = node.outputs[0]
+        return 300
 
     def load_image(self, crc):
         if crc == 0:
             return None
 
-        filepath = os.path.join(self.texture_dir, f'{crc:016X}.png')
-        try:
-            image = bpy.data.images.load(filepath, check_existing=True)
-        except Exception:
+        filename = f'{crc:016X}.png'
+        filepath = os.path.join(self.texture_dir, filename)
+        image = self.image_cache.get(filepath)
+        if image is not None:
+            return image
+
+        # Skip the load (and the exception) for files known to be missing
+        if self.texture_files is None or filename.lower() in self.texture_files:
+            try:
+                image = bpy.data.images.load(filepath, check_existing=True)
+            except Exception:
+                pass
+        if image is None:
             # Image didn't exist
             # Allow the path to be resolved later
-            image = bpy.data.images.new(os.path.basename(filepath), 16, 16)
+            image = bpy.data.images.new(filename, 16, 16)
             image.filepath = filepath
             image.source = 'FILE'
 
+        self.image_cache[filepath] = image
         return image
 
     def make_texture_unit(self, tex, tex_num, location):
         x, y = location
 
         # Image Texture node
-        node_tex = self.nodes.new('ShaderNodeTexImage')
+        node_tex = self.new_node('ShaderNodeTexImage')
         node_tex.name = node_tex.label = f'Texture {tex_num}'
         node_tex.width = 290
         node_tex.location = x - 150, y
-        node_tex.image = self.load_image(tex['crc'])
-        node_tex.interpolation = tex['filter']
+        node_tex.image = self.load_image(tex.crc)
+        node_tex.interpolation = tex.filter
         uv_socket = node_tex.inputs[0]
 
         x -= 370
@@ -476,11 +582,11 @@ class N64Shader:
         x -= 220
 
         # UVMap node
-        node_uv = self.nodes.new('ShaderNodeUVMap')
+        node_uv = self.new_node('ShaderNodeUVMap')
         node_uv.name = node_uv.label = f'UV Map Texture {tex_num}'
         node_uv.location = x - 160, y
-        node_uv.uv_map = tex['uv_map']
-        self.connect(node_uv.outputs[0], uv_socket)
+        node_uv.uv_map = tex.uv_map
+        self.connect_socket(node_uv.outputs[0], uv_socket)
 
         return node_tex
 
@@ -494,130 +600,338 @@ class N64Shader:
         # the same, we can do the whole wrapping calculation with the
         # Image Texture node's extension property.
 
-        extensions = [None, None]
-        for i in [0, 1]:
-            clamp = tex['clampS'] if i == 0 else tex['clampT']
-            wrap = tex['wrapS'] if i == 0 else tex['wrapT']
-            mirror = tex['mirrorS'] if i == 0 else tex['mirrorT']
-
-            # Clamps at image edge, no wrap
-            if clamp == 1 and (wrap == 0 or wrap >= 1):
-                extensions[i] = 'EXTEND'
-            # No clamp, wraps at texture edge
-            elif clamp == 0 and wrap == 1:
-                extensions[i] = 'MIRROR' if mirror else 'REPEAT'
-            # No clamp, no wrap (TODO: confirm this)
-            elif clamp == 0 and wrap == 0:
-                extensions[i] = 'EXTEND'
-
-        if extensions[0] == extensions[1] and extensions[0] != None:
-            node_tex.extension = extensions[i]
+        axes = [
+            (tex.clampS, tex.wrapS, tex.mirrorS),
+            (tex.clampT, tex.wrapT, tex.mirrorT),
+        ]
+        extension = get_texture_extension(*axes[0])
+        if extension is not None and extension == get_texture_extension(*axes[1]):
+            node_tex.extension = extension
             return node_tex.inputs[0]
 
         # Otherwise, separate the U and V and do clamp-wrap-mirror
-        # using math nodes.
+        # using math nodes (kept in node groups, one per combination of
+        # operations).
 
         node_tex.extension = 'EXTEND'
 
-        frame = self.nodes.new('NodeFrame')
-        frame.label = 'Clamp Wrap Mirror Texcoord'
+        frame = None
+        if self.emit_frames:
+            frame = self.new_node('NodeFrame')
+            frame.label = 'Clamp Wrap Mirror Texcoord'
 
         x, y = location
 
         # Combine XYZ
-        node_com = self.nodes.new('ShaderNodeCombineXYZ')
-        node_com.parent = frame
+        node_com = self.new_node('ShaderNodeCombineXYZ')
+        if frame:
+            node_com.parent = frame
         node_com.location = x - 80, y - 110
-        self.connect(node_com.outputs[0], node_tex.inputs[0])
+        self.connect_socket(node_com.outputs[0], node_tex.inputs[0])
 
         # Separate XYZ
-        node_sep = self.nodes.new('ShaderNodeSeparateXYZ')
-        node_sep.parent = frame
+        node_sep = self.new_node('ShaderNodeSeparateXYZ')
+        if frame:
+            node_sep.parent = frame
         node_sep.location = x - 80, y - 110
 
-        for i in [0, 1]:
-            clamp = tex['clampS'] if i == 0 else tex['clampT']
-            wrap = tex['wrapS'] if i == 0 else tex['wrapT']
-            mirror = tex['mirrorS'] if i == 0 else tex['mirrorT']
-
+        for i, (clamp, wrap, mirror) in enumerate(axes):
             socket = node_com.inputs[i]
 
             x, y = location
             x -= 120
             y -= 200 * i
 
-            # The clamp/wrap edges are given for a V >= 0 space. But
-            # we do (u,1-v) when importing UVs (because textures are
-            # upside down?), which turns it into a V <= 1 space.
-            #
-            # Converting the Ping Pong node for this space seems
-            # annoying, so instead, for the V direction only, we
-            # convert back to V >= 0 space with a 1-x Math node, do
-            # the wrapping as normal, then convert back again.
-            #
-            # This is rather ugly :/
-            if i == 1:
-                node = self.nodes.new('ShaderNodeMath')
-                node.parent = frame
-                node.location = x - 140, y
-                node.operation = 'SUBTRACT'
-                self.connect(node.outputs[0], socket)
-                node.inputs[0].default_value = 1
-                socket = node.inputs[1]
-                x -= 200
-
-            if wrap > 0:
-                if mirror:
-                    # Mirror with a Math/Ping Pong node
-                    node = self.nodes.new('ShaderNodeMath')
+            if wrap > 0 or clamp > 0:
+                axis_t = i == 1
+                do_wrap = wrap > 0
+                do_mirror = do_wrap and bool(mirror)
+                do_clamp = clamp > 0
+
+                ops = []
+                if do_clamp:
+                    ops.append('Clamp')
+                if do_wrap:
+                    ops.append('Mirror' if do_mirror else 'Wrap')
+                group_name = f"N64 {' '.join(ops)} {'T' if axis_t else 'S'}"
+
+                node = self.new_node('ShaderNodeGroup')
+                node.node_tree = get_node_group(
+                    group_name,
+                    lambda group: build_texcoord_wrapper_group(
+                        group, axis_t, do_wrap, do_mirror, do_clamp,
+                    ),
+                )
+                if frame:
                     node.parent = frame
-                    node.location = x - 140, y
-                    node.operation = 'PINGPONG'
-                    self.connect(node.outputs[0], socket)
-                    socket = node.inputs[0]
-                    node.inputs[1].default_value = wrap  # scale
-                else:
-                    # Wrap with a Math/Wrap node
-                    node = self.nodes.new('ShaderNodeMath')
-                    node.parent = frame
-                    node.location = x - 140, y
-                    node.operation = 'WRAP'
-                    self.connect(node.outputs[0], socket)
-                    socket = node.inputs[0]
-                    node.inputs[1].default_value = 0     # min
-                    node.inputs[2].default_value = wrap  # max
-                x -= 200
-
-            if clamp > 0:
-                # Clamp
-                node = self.nodes.new('ShaderNodeClamp')
-                node.parent = frame
                 node.location = x - 140, y
-                self.connect(node.outputs[0], socket)
-                socket = node.inputs[0]
-                node.inputs[1].default_value = 0      # min
-                node.inputs[2].default_value = clamp  # max
+                self.connect_socket(node.outputs[0], socket)
+                socket = node.inputs['Value']
+                if do_wrap:
+                    node.inputs['Wrap'].default_value = wrap
+                if do_clamp:
+                    node.inputs['Clamp'].default_value = clamp
                 x -= 200
 
-            # 1 - V converts V back into original UV space
-            if i == 1:
-                node = self.nodes.new('ShaderNodeMath')
-                node.parent = frame
-                node.location = x - 140, y
-                node.operation = 'SUBTRACT'
-                self.connect(node.outputs[0], socket)
-                node.inputs[0].default_value = 1
-                socket = node.inputs[1]
-                x -= 200
-
-            self.connect(node_sep.outputs[i], socket)
+            self.connect_socket(node_sep.outputs[i], socket)
 
             node_sep.location[0] = min(node_sep.location[0], x - 200)
 
         return node_sep.inputs[0]
 
 
+# Maps each input source to the N64Shader method that makes it, and an
+# extra argument for the method
+INPUT_MAKERS = {}
+for i in range(2):
+    for var in [f'Texel {i} Color', f'Texel {i} Alpha']:
+        INPUT_MAKERS[var] = N64Shader.make_texel_input, i
+for vc in ['Shade', 'Primitive', 'Env', 'Blend', 'Fog']:
+    for var in [f'{vc} Color', f'{vc} Alpha']:
+        INPUT_MAKERS[var] = N64Shader.make_vertex_color_input, vc
+INPUT_MAKERS['Fog Level'] = N64Shader.make_attribute_input, 'Fog Level'
+INPUT_MAKERS['Primitive LOD Fraction'] = N64Shader.make_attribute_input, 'Primitive LOD'
+INPUT_MAKERS['LOD Fraction'] = N64Shader.make_lod_fraction_input, None
+# Not yet implemented
+for var in ['Key Center', 'Key Scale', 'Noise', 'Convert K4', 'Convert K5']:
+    INPUT_MAKERS[var] = N64Shader.make_unimplemented_input, None
+
+
+def fold_combiner(a, b, c, d):
+    """
+    If the combiner formula (a-b)*c+d always equals one of its inputs,
+    returns that input. Otherwise returns None.
+    """
+    # (a-b)*0 + d = (a-a)*c + d = d
+    # (There are no C sources that decode to the constant 1, so no
+    # identities with c = 1 are needed.)
+    if c == '0' or a == b:
+        return d
+    return None
+
+
+def get_texture_extension(clamp, wrap, mirror):
+    """
+    Gets the Image Texture extension mode that does the clamp/wrap/mirror
+    for one axis, or None if it needs to be done with math nodes.
+    """
+    # Clamps at image edge, no wrap
+    if clamp == 1 and (wrap == 0 or wrap >= 1):
+        return 'EXTEND'
+    # No clamp, wraps at texture edge
+    if clamp == 0 and wrap == 1:
+        return 'MIRROR' if mirror else 'REPEAT'
+    # No clamp, no wrap (TODO: confirm this)
+    if clamp == 0 and wrap == 0:
+        return 'EXTEND'
+    return None
+
+
+def get_images_by_filepath():
+    """
+    Maps absolute filepaths to the images in bpy.data.images, in one
+    pass. This finds the images made by earlier imports (including the
+    placeholders for missing textures) without a lookup for each.
+    """
+    images = {}
+    for image in bpy.data.images:
+        if image.source == 'FILE' and image.filepath:
+            filepath = bpy.path.abspath(image.filepath, library=image.library)
+            images.setdefault(os.path.normpath(filepath), image)
+    return images
+
+
+def list_texture_files(texture_dir):
+    """
+    Lists the files in texture_dir in one pass, so missing textures
+    don't each need a failed load to find out. Names are lowercased
+    since the filesystem may not be case sensitive. Returns None if
+    the directory can't be read.
+    """
+    try:
+        with os.scandir(texture_dir) as entries:
+            return {entry.name.lower() for entry in entries}
+    except OSError:
+        return None
+
+
+def needs_alpha_blending(combiner1, combiner2, blender1, blender2):
+    """
+    Works out what use_alpha would be after building the nodes, without
+    building them. Must agree with make_combiners and make_blenders.
+    """
+    # Is the Combined Alpha the constant 1?
+    alpha = None
+    for combiner in [combiner1, combiner2]:
+        if not combiner:
+            break
+        v = fold_combiner(*combiner[4:])
+        if v is None:
+            alpha = None
+        elif v != 'Combined Alpha':
+            alpha = v
+
+    for blender in [blender1, blender2]:
+        if not blender:
+            break
+        if 'Framebuffer Color' in blender:
+            return alpha != '1'
+
+    return False
+
+
+def get_node_group(name, build):
+    """
+    Gets the shader node group with the given name, first creating it
+    with build(group) if it doesn't exist yet.
+    """
+    group = bpy.data.node_groups.get(name)
+    if group is None:
+        group = bpy.data.node_groups.new(name, 'ShaderNodeTree')
+        build(group)
+    return group
+
+
+def new_group_socket(group, in_out, socket_type, name):
+    if bpy.app.version >= (4, 0, 0):
+        return group.interface.new_socket(name, in_out=in_out, socket_type=socket_type)
+    elif in_out == 'INPUT':
+        return group.inputs.new(socket_type, name)
+    else:
+        return group.outputs.new(socket_type, name)
+
+
+def build_color_combiner_group(group):
+    for name in ['A', 'B', 'C', 'D']:
+        new_group_socket(group, 'INPUT', 'NodeSocketColor', name)
+    new_group_socket(group, 'OUTPUT', 'NodeSocketColor', 'Color')
+
+    node_in = group.nodes.new('NodeGroupInput')
+    node_in.location = -250, 0
+    out = node_in.outputs['A']
+
+    # A - B, * C, + D
+    for i, (blend_type, arg) in enumerate([('SUBTRACT', 'B'), ('MULTIPLY', 'C'), ('ADD', 'D')]):
+        node = group.nodes.new('ShaderNodeMix')
+        node.data_type = 'RGBA'
+        node.blend_type = blend_type
+        node.inputs[MIX_FAC].default_value = 1
+        node.location = 230 * i, -120 * i
+        group.links.new(out, node.inputs[MIX_COLOR_A])
+        group.links.new(node_in.outputs[arg], node.inputs[MIX_COLOR_B])
+        out = node.outputs[MIX_COLOR_RESULT]
+
+    node_out = group.nodes.new('NodeGroupOutput')
+    node_out.location = 700, -240
+    group.links.new(out, node_out.inputs['Color'])
+
+
+def build_alpha_combiner_group(group):
+    for name in ['A', 'B', 'C', 'D']:
+        new_group_socket(group, 'INPUT', 'NodeSocketFloat', name)
+    new_group_socket(group, 'OUTPUT', 'NodeSocketFloat', 'Alpha')
+
+    node_in = group.nodes.new('NodeGroupInput')
+    node_in.location = -250, 0
+
+    # A - B
+    node1 = group.nodes.new('ShaderNodeMath')
+    node1.operation = 'SUBTRACT'
+    node1.location = 0, 0
+    group.links.new(node_in.outputs['A'], node1.inputs[0])
+    group.links.new(node_in.outputs['B'], node1.inputs[1])
+
+    # * C + D
+    node2 = group.nodes.new('ShaderNodeMath')
+    node2.operation = 'MULTIPLY_ADD'
+    node2.location = 230, -20
+    group.links.new(node1.outputs[0], node2.inputs[0])
+    group.links.new(node_in.outputs['C'], node2.inputs[1])
+    group.links.new(node_in.outputs['D'], node2.inputs[2])
+
+    node_out = group.nodes.new('NodeGroupOutput')
+    node_out.location = 460, 0
+    group.links.new(node2.outputs[0], node_out.inputs['Alpha'])
+
+
+def build_texcoord_wrapper_group(group, axis_t, wrap, mirror, clamp):
+    """
+    Builds a group that does the clamp-wrap-mirror for one texcoord.
+    The wrap and clamp edges are inputs, so the group can be shared
+    by every texture with the same operations on that axis.
+    """
+    new_group_socket(group, 'INPUT', 'NodeSocketFloat', 'Value')
+    if wrap:
+        new_group_socket(group, 'INPUT', 'NodeSocketFloat', 'Wrap')
+    if clamp:
+        new_group_socket(group, 'INPUT', 'NodeSocketFloat', 'Clamp')
+    new_group_socket(group, 'OUTPUT', 'NodeSocketFloat', 'Value')
+
+    node_in = group.nodes.new('NodeGroupInput')
+    node_in.location = -200, 0
+    socket = node_in.outputs['Value']
+    x = 0
+
+    def new_node(node_type):
+        nonlocal x
+        node = group.nodes.new(node_type)
+        node.location = x, 0
+        x += 200
+        return node
+
+    def one_minus(socket):
+        node = new_node('ShaderNodeMath')
+        node.operation = 'SUBTRACT'
+        node.inputs[0].default_value = 1
+        group.links.new(socket, node.inputs[1])
+        return node.outputs[0]
+
+    # The clamp/wrap edges are given for a V >= 0 space. But we do
+    # (u,1-v) when importing UVs (because textures are upside down?),
+    # which turns it into a V <= 1 space.
+    #
+    # Converting the Ping Pong node for this space seems annoying, so
+    # instead, for the V direction only, we convert back to V >= 0
+    # space with a 1-x Math node, do the wrapping as normal, then
+    # convert back again.
+    #
+    # This is rather ugly :/
+    if axis_t:
+        socket = one_minus(socket)
+
+    if clamp:
+        node = new_node('ShaderNodeClamp')
+        group.links.new(socket, node.inputs[0])
+        node.inputs[1].default_value = 0                           # min
+        group.links.new(node_in.outputs['Clamp'], node.inputs[2])  # max
+        socket = node.outputs[0]
+
+    if wrap:
+        node = new_node('ShaderNodeMath')
+        group.links.new(socket, node.inputs[0])
+        if mirror:
+            # Mirror with a Math/Ping Pong node
+            node.operation = 'PINGPONG'
+            group.links.new(node_in.outputs['Wrap'], node.inputs[1])  # scale
+        else:
+            # Wrap with a Math/Wrap node
+            node.operation = 'WRAP'
+            node.inputs[1].default_value = 0                          # min
+            group.links.new(node_in.outputs['Wrap'], node.inputs[2])  # max
+        socket = node.outputs[0]
+
+    # 1 - V converts V back into original UV space
+    if axis_t:
+        socket = one_minus(socket)
+
+    node_out = new_node('NodeGroupOutput')
+    group.links.new(socket, node_out.inputs['Value'])
+
+
 def show_texture_info(tex):
-    crc = tex['crc']
-    tfilter = tex['filter']
+    return _show_texture_info(tex.crc, tex.filter)
+
+
+@lru_cache(maxsize=4096)
+def _show_texture_info(crc, tfilter):
     return f'{crc:016X},{tfilter}'
@@ -1,7 +1,11 @@
+from functools import lru_cache
+
+
 ###############################
 # Get N64 configuration state
 ###############################
 
+@lru_cache(maxsize=4096)
 def get_texture_filter(other_mode):
     # 0 = TF_POINT    Point Sampling
     # 1 = Invalid
@@ -11,23 +15,24 @@ def get_texture_filter(other_mode):
     return 'Closest' if filter == 0 else 'Linear'
 
 
+# Microcodes in the F3DEX2 family
+F3DEX2_MICROCODES = frozenset([
+    2,   # F3DEX2
+    5,   # L3DEX2
+    7,   # S2DEX2
+    13,  # F3DEX2CBFD
+    17,  # F3DZEX2OOT
+    18,  # F3DZEX2MM
+    21,  # F3DEX2ACCLAIM
+])
+
+
 def get_backface_culling(geometry_mode, microcode):
     # Determine backface culling
     # F3D/F3DEX: 0x2000 (0010 0000 0000 0000)
     # F3DEX2: 0x400 (0100 0000 0000)
     # TODO: Check others, assumed under F3D/F3DEX family
-    mask = 0x2000
-    if (
-        microcode == 2 or  # F3DEX2
-        microcode == 5 or  # L3DEX2
-        microcode == 7 or  # S2DEX2
-        microcode == 13 or # F3DEX2CBFD
-        microcode == 17 or # F3DZEX2OOT
-        microcode == 18 or # F3DZEX2MM
-        microcode == 21    # F3DEX2ACCLAIM
-    ):
-        mask >>= 3
-
+    mask = 0x400 if microcode in F3DEX2_MICROCODES else 0x2000
     return bool(geometry_mode & mask)
 
 
@@ -35,6 +40,7 @@ def get_backface_culling(geometry_mode, microcode):
 # Pretty-print formulas
 #########################
 
+@lru_cache(maxsize=4096)
 def show_combiner_formula(a, b, c, d):
     # Formats (a-b)*c+d as a human readable string
 
@@ -65,6 +71,7 @@ def show_combiner_formula(a, b, c, d):
     return add
 
 
+@lru_cache(maxsize=4096)
 def show_blender_formula(p, a, m, b):
     # Formats (p*a + m*b)/(a+b) as a human readable string
     # The denominator (a+b) is omitted for brevity.
@@ -171,6 +178,17 @@ ALPHA_C_TABLE = {
 }
 
 
+# Flat lookup tuples, indexed directly by the raw mux fields. The RGB
+# fields are wider than their tables, so pad the unused values with '0'.
+RGB_A_TUP = tuple(RGB_A_TABLE.get(i, '0') for i in range(16))
+RGB_B_TUP = tuple(RGB_B_TABLE.get(i, '0') for i in range(16))
+RGB_C_TUP = tuple(RGB_C_TABLE.get(i, '0') for i in range(32))
+RGB_D_TUP = tuple(RGB_D_TABLE.get(i, '0') for i in range(8))
+ALPHA_ABD_TUP = tuple(ALPHA_ABD_TABLE[i] for i in range(8))
+ALPHA_C_TUP = tuple(ALPHA_C_TABLE[i] for i in range(8))
+
+
+@lru_cache(maxsize=4096)
 def decode_combiner_mode(mux):
     # Decodes the u64 combiner mux value into the 16 input sources to
     # the color combiner.
@@ -206,21 +224,12 @@ def decode_combiner_mode(mux):
 
 def decode_rgb_combiner_abcd(a, b, c, d):
     # http://n64devkit.square7.ch/tutorial/graphics/4/image07.gif
-    a = RGB_A_TABLE.get(a, '0')
-    b = RGB_B_TABLE.get(b, '0')
-    c = RGB_C_TABLE.get(c, '0')
-    d = RGB_D_TABLE.get(d, '0')
-    return a, b, c, d
+    return RGB_A_TUP[a], RGB_B_TUP[b], RGB_C_TUP[c], RGB_D_TUP[d]
 
 
 def decode_alpha_combiner_abcd(a, b, c, d):
     # http://n64devkit.square7.ch/tutorial/graphics/5/image13.gif
-
-    a = ALPHA_ABD_TABLE[a]
-    b = ALPHA_ABD_TABLE[b]
-    c = ALPHA_C_TABLE[c]
-    d = ALPHA_ABD_TABLE[d]
-    return a, b, c, d
+    return ALPHA_ABD_TUP[a], ALPHA_ABD_TUP[b], ALPHA_C_TUP[c], ALPHA_ABD_TUP[d]
 
 
 ######################
@@ -253,15 +262,22 @@ def decode_blender_mode(other_mode):
     # Decodes the mux value in the other_mode state into the eight input
     # sources for the blender.
 
+    # Only bits 16-31 matter, so cache on those alone; the rest of
+    # other_mode (filtering, cycle type, etc.) varies a lot more.
+    return _decode_blender_mux((other_mode >> 16) & 0xFFFF)
+
+
+@lru_cache(maxsize=4096)
+def _decode_blender_mux(mux):
     # 1/2 means first/second cycle
-    b_2 = (other_mode >> 16) & 0x3
-    b_1 = (other_mode >> 18) & 0x3
-    m_2 = (other_mode >> 20) & 0x3
-    m_1 = (other_mode >> 22) & 0x3
-    a_2 = (other_mode >> 24) & 0x3
-    a_1 = (other_mode >> 26) & 0x3
-    p_2 = (other_mode >> 28) & 0x3
-    p_1 = (other_mode >> 30) & 0x3
+    b_2 = (mux >> 0) & 0x3
+    b_1 = (mux >> 2) & 0x3
+    m_2 = (mux >> 4) & 0x3
+    m_1 = (mux >> 6) & 0x3
+    a_2 = (mux >> 8) & 0x3
+    a_1 = (mux >> 10) & 0x3
+    p_2 = (mux >> 12) & 0x3
+    p_1 = (mux >> 14) & 0x3
 
     pamb1 = decode_blender_pamb(p_1, a_1, m_1, b_1)
     pamb2 = decode_blender_pamb(p_2, a_2, m_2, b_2)
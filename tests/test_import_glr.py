@@ -0,0 +1,95 @@
+import struct
+
+import numpy as np
+import pytest
+
+# The importer needs Blender's Python modules (eg. the bpy package)
+bpy = pytest.importorskip('bpy')
+
+from io_import_glr import import_glr  # noqa: E402
+
+
+def write_glr(path, tris, microcode=2):
+    header = import_glr.HEADER_STRUCT.pack(b'GL64R\0', 4, b'TEST', len(tris), microcode)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(tris.tobytes())
+
+
+def make_tris(num_tris, seed=0):
+    rng = np.random.default_rng(seed)
+    tris = np.zeros(num_tris, dtype=import_glr.TRIANGLE_DTYPE)
+    tris['verts']['co'] = rng.uniform(-100, 100, tris['verts']['co'].shape)
+    tris['verts']['color'] = 1
+    tris['combiner_mux'] = 0x00FFFFFFFFFCFA7D  # Shade Color
+    tris['other_mode'] = 0x0C184240
+    return tris
+
+
+def test_filter_list_with_repeated_crcs(tmp_path):
+    # Enough CRCs that NumPy's isin takes its sorting path, and every
+    # CRC used by many tris
+    rng = np.random.default_rng(1)
+    crcs = rng.integers(1, 2**63, size=61, dtype=np.uint64) * 2 + 1
+    tris = make_tris(2000)
+    tris['tex0_crc'] = rng.choice(crcs, size=len(tris))
+
+    path = tmp_path / 'filter.glr'
+    write_glr(path, tris)
+
+    filtered = crcs[::2]
+    filter_str = ','.join(f'{crc:016X}' for crc in filtered)
+    listed = np.array([crc in set(filtered.tolist()) for crc in tris['tex0_crc'].tolist()])
+
+    ob = import_glr.load_glr(str(path), filter_list=filter_str, filter_mode=True)
+    assert len(ob.data.polygons) == np.count_nonzero(~listed)
+
+    ob = import_glr.load_glr(str(path), filter_list=filter_str, filter_mode=False)
+    assert len(ob.data.polygons) == np.count_nonzero(listed)
+
+
+def test_merge_distance(tmp_path):
+    tris = make_tris(4)
+    # Shares an exact vertex with tri 0
+    tris[1]['verts']['co'][0] = tris[0]['verts']['co'][0]
+    # 2e-5 apart, on either side of x = 0.0005
+    tris[2]['verts']['co'][0] = (0.00049, 50, 50)
+    tris[3]['verts']['co'][0] = (0.00051, 50, 50)
+    # 0.0014 apart, but rounding to the same 0.001 grid point
+    tris[2]['verts']['co'][1] = (10.0004, 10.0004, 10.0004)
+    tris[3]['verts']['co'][1] = (9.9996, 9.9996, 9.9996)
+
+    path = tmp_path / 'merge.glr'
+    write_glr(path, tris)
+
+    ob = import_glr.load_glr(str(path), merge_doubles=True, merge_distance=0.001)
+    xs = [v.co.x for v in ob.data.vertices]
+    assert sum(abs(x - 0.0005) < 0.001 for x in xs) == 1
+    assert sum(abs(x - 10) < 0.001 for x in xs) == 2
+    assert len(xs) == 12 - 2
+    assert len(ob.data.polygons) == 4
+
+    ob = import_glr.load_glr(str(path), merge_doubles=True, merge_distance=0.0)
+    assert len(ob.data.vertices) == 12 - 1
+
+
+def test_missing_textures_reuse_placeholders(tmp_path):
+    tris = make_tris(20)
+    tris['tex0_crc'] = [0x1234ABCD, 0x5678EF01] * 10
+    for i in range(2):
+        write_glr(tmp_path / f'tex{i}.glr', tris)
+
+    def num_images():
+        return sum(image.source == 'FILE' for image in bpy.data.images)
+
+    before = num_images()
+    for i in range(2):
+        import_glr.load_glr(str(tmp_path / f'tex{i}.glr'))
+    assert num_images() == before + 2
+
+    # Importing again after the materials are gone finds the
+    # placeholders made the first time
+    for mat in list(bpy.data.materials):
+        bpy.data.materials.remove(mat)
+    import_glr.load_glr(str(tmp_path / 'tex0.glr'))
+    assert num_images() == before + 2